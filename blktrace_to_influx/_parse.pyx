@@ -0,0 +1,54 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+""" Compiled iter_records(), build it in place with: cythonize -i blktrace_to_influx/_parse.pyx
+
+The extension is optional. blktrace_api uses it instead of its pure Python version when it can be imported.
+"""
+from libc.string cimport memcpy
+
+from blktrace_to_influx.blktrace_api import BlkparseRecord, _MAGIC, _VERSION, _verify
+
+
+# struct blk_io_trace, in host byte order (blktrace_api only uses this module on little endian hosts)
+cdef packed struct blk_hdr:
+    int magic
+    int sequence
+    long long time
+    long long sector
+    int bytes
+    int action
+    int pid
+    int device
+    int cpu
+    short error
+    unsigned short pdu_len
+
+
+def iter_records(buf):
+    """ Walk all records in buf (usually from map_file()), stopping at the first incomplete header. """
+    cdef const unsigned char[::1] view
+    cdef Py_ssize_t size = sizeof(blk_hdr)
+    cdef Py_ssize_t end = len(buf)
+    cdef Py_ssize_t off = 0
+    cdef int magic = _MAGIC | _VERSION
+    cdef blk_hdr h
+
+    if end < size:
+        return
+
+    view = buf
+    pdu_view = memoryview(buf)  # pdu_data are views into buf, not copies
+    tuple_new = tuple.__new__
+
+    while off + size <= end:
+        memcpy(&h, &view[off], size)
+        off += size
+        if h.magic != magic:
+            _verify(h.magic)
+
+        pdu_data = None
+        if h.pdu_len > 0:
+            pdu_data = pdu_view[off:off + h.pdu_len]
+            off += h.pdu_len
+
+        yield tuple_new(BlkparseRecord, (h.magic, h.sequence, h.time, h.sector, h.bytes, h.action,
+                                        h.pid, h.device, h.cpu, h.error, h.pdu_len, pdu_data))
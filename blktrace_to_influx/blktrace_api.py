@@ -1,11 +1,18 @@
-from enum import Enum, Flag, auto
+from enum import Enum, IntFlag, auto
 from io import IOBase
+import mmap
+import os
 import struct
-from dataclasses import dataclass
-from typing import Any, Tuple, Optional
+import sys
+from typing import Any, Iterator, NamedTuple, Tuple
 
+# struct blk_io_trace, as written by blktrace(8): little endian, time and sector are 64 bit, pdu_len is an u16
+_RECORD = struct.Struct("<iiqqiiiiihH")
+_MAGIC = 0x65617400
+_VERSION = 7
 
-class TraceCategory(Flag):
+
+class TraceCategory(IntFlag):
     READ = 1 << 16
     WRITE = 1 << 17
     FLUSH = 1 << 18
@@ -62,31 +69,31 @@ class _TraceAction(Enum):
 
 
 class TraceAction(Enum):
-    QUEUE = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.QUEUE)
-    BACKMERGE = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.BACKMERGE)
-    FRONTMERGE = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.FRONTMERGE)
-    GETRQ = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.GETRQ)
-    SLEEPR = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.SLEEPRQ)
+    QUEUE = (1 << 20) | 1  # QUEUE | _TraceAction.QUEUE
+    BACKMERGE = (1 << 20) | 2  # QUEUE | _TraceAction.BACKMERGE
+    FRONTMERGE = (1 << 20) | 3  # QUEUE | _TraceAction.FRONTMERGE
+    GETRQ = (1 << 20) | 4  # QUEUE | _TraceAction.GETRQ
+    SLEEPR = (1 << 20) | 5  # QUEUE | _TraceAction.SLEEPRQ
 
-    REQUEUE = TraceCategory.to_value(TraceCategory.REQUEUE, _TraceAction.REQUEUE)
+    REQUEUE = (1 << 21) | 6  # REQUEUE | _TraceAction.REQUEUE
 
-    ISSUE = TraceCategory.to_value(TraceCategory.ISSUE, _TraceAction.ISSUE)
+    ISSUE = (1 << 22) | 7  # ISSUE | _TraceAction.ISSUE
 
-    COMPLETE = TraceCategory.to_value(TraceCategory.COMPLETE, _TraceAction.COMPLETE)
+    COMPLETE = (1 << 23) | 8  # COMPLETE | _TraceAction.COMPLETE
 
-    PLUG = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.PLUG)
-    UNPLUG_IO = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.UNPLUG_IO)
-    UNPLUG_TIMER = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.UNPLUG_TIMER)
+    PLUG = (1 << 20) | 9  # QUEUE | _TraceAction.PLUG
+    UNPLUG_IO = (1 << 20) | 10  # QUEUE | _TraceAction.UNPLUG_IO
+    UNPLUG_TIMER = (1 << 20) | 11  # QUEUE | _TraceAction.UNPLUG_TIMER
 
-    INSERT = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.INSERT)
-    SPLIT = _TraceAction.SPLIT.value
-    BOUNCE = _TraceAction.BOUNCE.value
+    INSERT = (1 << 20) | 12  # QUEUE | _TraceAction.INSERT
+    SPLIT = 13  # _TraceAction.SPLIT
+    BOUNCE = 14  # _TraceAction.BOUNCE
 
-    REMAP = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.REMAP)
-    ABORT = TraceCategory.to_value(TraceCategory.QUEUE, _TraceAction.ABORT)
-    DRV_DAT = TraceCategory.to_value(TraceCategory.DRV_DATA, _TraceAction.DRV_DATA)
+    REMAP = (1 << 20) | 15  # QUEUE | _TraceAction.REMAP
+    ABORT = (1 << 20) | 16  # QUEUE | _TraceAction.ABORT
+    DRV_DAT = (1 << 30) | 17  # DRV_DATA | _TraceAction.DRV_DATA
 
-    CGROUP = _TraceAction.CGROUP.value
+    CGROUP = 1 << 8  # _TraceAction.CGROUP
 
 
 class TraceNotify(Enum):
@@ -95,8 +102,17 @@ class TraceNotify(Enum):
     MESSAGE = auto()  # character string message
 
 
-@dataclass(frozen=True, slots=True)
-class BlkparseRecord:
+# Plain int versions of the masks and values above, for code that looks at every record
+CATEGORY_MASK = 0xffff0000
+ACTION_MASK = 0x0000ff7f
+CGROUP_MASK = 0x00000080
+NOTIFY_MASK = 1 << 26  # TraceCategory.NOTIFY
+NOTIFY_PROCESS = 0  # TraceNotify.PROCESS
+NOTIFY_TIMESTAMP = 1  # TraceNotify.TIMESTAMP
+NOTIFY_MESSAGE = 2  # TraceNotify.MESSAGE
+
+
+class BlkparseRecord(NamedTuple):
     magic: int  # 0x65617400 || version (currently: 7)
     sequence: int  # event number
     time: int  # in nanoseconds
@@ -108,27 +124,7 @@ class BlkparseRecord:
     cpu: int  # on what cpu did it happen
     error: int  # completion error
     pdu_len: int  # length of data after this trace
-    pdu_data: Any  # The PDU content
-
-    def verify_trace(self) -> bool:
-        magic_mask = 0xffffff00
-        magic_expected = 0x65617400
-        version_mask = 0x000000ff
-        version_expected = 7
-
-        m = self.magic & magic_mask
-        if m != magic_expected:
-            raise ValueError(f'Magic Byte found {m:x}, expected {magic_expected:x}')
-
-        version = self.magic & version_mask
-        if version != version_expected:
-            raise ValueError(f'Version found {version}, expected {version_expected}')
-
-        return True
-
-    def __post_init__(self):
-        """ Force validation of the magic bytes andthe serial number. """
-        self.verify_trace()
+    pdu_data: Any  # The PDU content, a memoryview into the trace
 
     def as_timepair(self) -> (int, int):
         """ Return the time as a pair (seconds, nanoseconds) """
@@ -145,42 +141,94 @@ class BlkparseRecord:
         return major, minor
 
 
-def classify(value: int) -> Tuple[TraceCategory, TraceNotify | _TraceAction, int]:
-    tc = None
-    tn = None
-    ta = None
-    cg = 0
+def _verify(magic: int) -> bool:
+    """ Validate the magic bytes and the version of a record. """
+    magic_mask = 0xffffff00
+    magic_expected = _MAGIC
+    version_mask = 0x000000ff
+    version_expected = _VERSION
+
+    m = magic & magic_mask
+    if m != magic_expected:
+        raise ValueError(f'Magic Byte found {m:x}, expected {magic_expected:x}')
+
+    version = magic & version_mask
+    if version != version_expected:
+        raise ValueError(f'Version found {version}, expected {version_expected}')
+
+    return True
+
 
-    hi = (value & 0xffff0000) >> 16
-    lo = value & 0x0000ffff
-    print(f"DEBUG: {hi:b} {lo:b}")
+# Value to member tables for classify(), a dict lookup is much cheaper than calling the Enum class.
+# Flag combinations are not members, they are added to the table on first use.
+_CAT_BY_VAL = {c.value: c for c in TraceCategory}
+_ACT_BY_VAL = {a.value: a for a in _TraceAction}
+_NOTIFY_BY_VAL = {n.value: n for n in TraceNotify}
 
-    tc = TraceCategory(value & 0xffff0000)
+
+def _decode(table: dict, cls, value: int):
+    member = table.get(value)
+    if member is None:
+        member = table[value] = cls(value)
+
+    return member
+
+
+def classify(value: int) -> Tuple[TraceCategory, TraceNotify | _TraceAction, int]:
+    tc = _decode(_CAT_BY_VAL, TraceCategory, value & CATEGORY_MASK)
     if tc == TraceCategory.NOTIFY:
-        tr = TraceNotify(value & 0x0000ff7f)
+        tr = _decode(_NOTIFY_BY_VAL, TraceNotify, value & ACTION_MASK)
     else:
-        tr = _TraceAction(value & 0x0000ff7f)
+        tr = _decode(_ACT_BY_VAL, _TraceAction, value & ACTION_MASK)
 
-    cg = value & 0x00000080
+    cg = value & CGROUP_MASK
 
     return tc, tr, cg
 
 
-def fetch_blkparse_record(f: IOBase) -> Optional[BlkparseRecord]:
-    the_record = struct.Struct("iilliiiiihh")
+def map_file(f: IOBase) -> mmap.mmap | bytes:
+    """ Map an open trace file read-only. mmap() refuses empty files, these map to b"". """
+    if os.fstat(f.fileno()).st_size == 0:
+        return b""
+
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_records(buf) -> Iterator[BlkparseRecord]:
+    """ Walk all records in buf (usually from map_file()), stopping at the first incomplete header. """
+    unpack_from = _RECORD.unpack_from
+    size = _RECORD.size
+    make = BlkparseRecord._make
+    no_pdu = (None,)
+    view = memoryview(buf)  # pdu_data are views into buf, not copies
+    end = len(buf)
+    off = 0
+
+    # There is exactly one valid magic value, so a plain compare is all the check a record needs.
+    # _verify() only runs to explain a mismatch.
+    magic = _MAGIC | _VERSION
+
+    while off + size <= end:
+        unpacked = unpack_from(buf, off)
+        off += size
+        if unpacked[0] != magic:
+            _verify(unpacked[0])
+
+        # Optional record extension (extension length is the last field).
+        # Only notify records carry one, everything else takes the short path.
+        pdu_len = unpacked[-1]
+        if pdu_len == 0:
+            yield make(unpacked + no_pdu)
+            continue
+
+        pdu_data = view[off:off + pdu_len]
+        off += pdu_len
+        yield make(unpacked + (pdu_data,))
+
 
-    # read the record and tentatively unpack it
+# Prefer the compiled iter_records() from _parse.pyx if it has been built. It reads headers in host byte order.
+if sys.byteorder == "little":
     try:
-        buf = f.read(the_record.size)
-        unpacked = the_record.unpack(buf)
-    except IOError:
-        return None
-    except struct.error:
-        return None
-
-    # Read optional record extension (extension length is the last field)
-    pdu_data = None
-    if unpacked[-1] > 0:
-        pdu_data = f.read(unpacked[-1])
-
-    return BlkparseRecord(*unpacked, pdu_data=pdu_data)
+        from blktrace_to_influx._parse import iter_records
+    except ImportError:
+        pass
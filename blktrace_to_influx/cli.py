@@ -1,11 +1,33 @@
+import glob
 import struct
 import sys
 from pathlib import Path
+from typing import Optional, Tuple
 
 import click
 
 from blktrace_to_influx.global_state import GlobalState
-from blktrace_to_influx.blktrace_api import *
+from blktrace_to_influx.blktrace_api import (
+    _MAGIC,
+    _RECORD,
+    _VERSION,
+    _verify,
+    ACTION_MASK,
+    NOTIFY_MASK,
+    NOTIFY_MESSAGE,
+    NOTIFY_PROCESS,
+    NOTIFY_TIMESTAMP,
+    TraceCategory,
+    classify,
+    iter_records,
+    map_file,
+)
+
+# TIMESTAMP notify payload: wall clock seconds and nanoseconds at the time of the record
+_TS = struct.Struct('<ii')
+
+# magic, action and pdu_len of a _RECORD header, for scanning a trace without building records
+_SCAN = struct.Struct('<i24xi14xH')
 
 
 @click.group(help="Import blktrace files into Influx")
@@ -16,48 +38,150 @@ def cli(ctx, debug):
     ctx.obj.debug = debug
 
 
+def _scan_timestamp(buf) -> Optional[Tuple[Tuple[int, int], Tuple[int, int]]]:
+    """ Find the TIMESTAMP notify in buf (from map_file()), return its (kernel clock, wall clock) or None.
+
+    Both clocks are (seconds, nanoseconds) pairs. Only magic, action and pdu_len of each header are unpacked.
+    """
+    unpack_from = _SCAN.unpack_from
+    size = _RECORD.size
+    magic = _MAGIC | _VERSION
+    notify_mask = NOTIFY_MASK
+    action_mask = ACTION_MASK
+    notify_timestamp = NOTIFY_TIMESTAMP
+    end = len(buf)
+    off = 0
+
+    while off + size <= end:
+        m, action, pdu_len = unpack_from(buf, off)
+        if m != magic:
+            _verify(m)
+
+        if action & notify_mask and action & action_mask == notify_timestamp:
+            if pdu_len != 8 or off + size + pdu_len > end:
+                raise (ValueError(f'TraceNotify.TIMESTAMP has payload len != 8, at offset {off}'))
+
+            sec, nanosec = _TS.unpack_from(buf, off + size)
+            if nanosec < 0:
+                sec -= 1
+                nanosec += 1000000000
+
+            return divmod(_RECORD.unpack_from(buf, off)[2], 1000000000), (sec, nanosec)
+
+        off += size + pdu_len
+
+    return None
+
+
+def _find_timestamp(full_filename: Path, mm) -> Tuple[Tuple[int, int], Tuple[int, int]]:
+    """ Find the TIMESTAMP notify of the trace that full_filename (mapped as mm) belongs to, see _scan_timestamp().
+
+    blktrace writes the TIMESTAMP notify into only one of the per-cpu files <name>.blktrace.<cpu>,
+    so after full_filename itself its siblings are searched. Siblings that cannot be read or parsed are skipped.
+    """
+    found = _scan_timestamp(mm)
+    if found is not None:
+        return found
+
+    name, sep, _ = full_filename.name.rpartition('.blktrace.')
+    siblings = []
+    if sep:
+        prefix = f"{name}.blktrace."
+        for path in full_filename.parent.glob(f"{glob.escape(prefix)}*"):
+            cpu = path.name[len(prefix):]
+            if cpu.isdigit() and path != full_filename:
+                siblings.append((int(cpu), path))
+
+    for _, path in sorted(siblings):
+        try:
+            with open(path, "rb") as f:
+                found = _scan_timestamp(map_file(f))
+        except (OSError, ValueError):
+            continue
+
+        if found is not None:
+            return found
+
+    raise click.ClickException(f"No TIMESTAMP notify in {full_filename} or its sibling .blktrace.N files, "
+                               f"cannot convert record times to wall clock time.")
+
+
 @cli.command()
 @click.option('-D', '--directory', default=".")
 @click.argument('filename')
 @click.pass_obj
 def dumpfile(g: GlobalState, filename: str, directory: str):
     full_filename = Path(directory) / filename
+
     try:
         with open(full_filename, "rb") as f:
-            while r := fetch_blkparse_record(f):
-                print(r)
-                print(classify(r.action))
-                print()
-
-                tc, tn, cg = classify(r.action)
-                if TraceCategory.NOTIFY in tc:
-                    if tn == TraceNotify.PROCESS:
-                        g.add_program(r)
-                        continue
-
-                    if tn == TraceNotify.TIMESTAMP:
-                        if r.pdu_len != 8:
-                            raise (ValueError(f'TraceNotify.TIMESTAMP has payload len != 8, {r}'))
-
-                        g.start_timestamp = r.as_timepair()
-                        sec, nanosec = struct.Struct('ii').unpack(r.pdu_data)
-                        if nanosec < 0:
-                            sec -= 1
-                            nanosec += 1000000000
-                        g.abs_timestamp = sec, nanosec
-                        continue
-
-                    if tn == TraceNotify.MESSAGE:
-                        raise (ValueError('tn.MESSAGE'))
-
+            mm = map_file(f)
     except IOError as e:
-        print(f"Error reading file {full_filename}: {e}")
+        print(f"Error reading file {full_filename}: {e}", file=sys.stderr)
         sys.exit(1)
 
+    g.start_timestamp, g.abs_timestamp = _find_timestamp(full_filename, mm)
+
+    # Record times are kernel clock ns, this turns them into wall clock ns
+    start_sec, start_nanosec = g.start_timestamp
+    abs_sec, abs_nanosec = g.abs_timestamp
+    time_offset = (abs_sec - start_sec) * 1000000000 + abs_nanosec - start_nanosec
+
+    # Influx line protocol output is collected and written in batches of this many lines
+    batch_size = 5000
+    lines = []
+    append = lines.append
+    write = sys.stdout.write
+
+    # Names used for every record, bound to locals once
+    debug = g.debug
+    add_program = g.add_program
+    notify_mask = NOTIFY_MASK
+    action_mask = ACTION_MASK
+    notify_process = NOTIFY_PROCESS
+    notify_timestamp = NOTIFY_TIMESTAMP
+    notify_message = NOTIFY_MESSAGE
+
+    for r in iter_records(mm):
+        if debug:
+            # stdout carries the line protocol
+            print(r, file=sys.stderr)
+            print(classify(r.action), file=sys.stderr)
+            print(file=sys.stderr)
+
+        action = r.action
+        if action & notify_mask:
+            tn = action & action_mask
+            if tn == notify_process:
+                add_program(r)
+                continue
+
+            if tn == notify_timestamp:
+                # Already applied through _find_timestamp()
+                continue
+
+            if tn == notify_message:
+                raise (ValueError('tn.MESSAGE'))
+
+            continue
+
+        major, minor = r.as_maj_min()
+        append(f"disk,major={major},minor={minor},cpu={r.cpu} "
+               f"action={action}i,sector={r.sector}i,bytes={r.bytes}i,pid={r.pid}i,error={r.error}i "
+               f"{r.time + time_offset}")
+        if len(lines) >= batch_size:
+            write("\n".join(lines))
+            write("\n")
+            lines.clear()
+
+    if lines:
+        write("\n".join(lines))
+        write("\n")
+
 
 @cli.command()
 @click.pass_context
 def test(ctx):
     print(f"{ctx.obj.debug=}")
-    print(TraceCategory.NOTIFY)
+    print(repr(TraceCategory.NOTIFY))
     print(TraceCategory.to_value(TraceCategory.NOTIFY))
@@ -0,0 +1,122 @@
+""" Columnar access to blktrace files: all record headers of a trace as one numpy structured array.
+
+numpy is optional, install the package with the "columnar" extra to use this module.
+With the "jit" extra, numba compiles the offset scan, the only part that has to walk the file record by record.
+"""
+import struct
+from typing import Tuple
+
+import numpy as np
+
+from blktrace_to_influx.blktrace_api import _MAGIC, _RECORD, _VERSION, _verify, ACTION_MASK, CATEGORY_MASK, CGROUP_MASK
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# The same layout as _RECORD, one column per struct blk_io_trace member
+_DTYPE = np.dtype([
+    ('magic', '<i4'),
+    ('sequence', '<i4'),
+    ('time', '<i8'),
+    ('sector', '<i8'),
+    ('bytes', '<i4'),
+    ('action', '<i4'),
+    ('pid', '<i4'),
+    ('device', '<i4'),
+    ('cpu', '<i4'),
+    ('error', '<i2'),
+    ('pdu_len', '<u2'),
+])
+assert _DTYPE.itemsize == _RECORD.size
+
+_PDU_LEN = struct.Struct("<H")
+_PDU_LEN_AT = _DTYPE.fields['pdu_len'][1]
+
+if njit is not None:
+    @njit(cache=True)
+    def _scan_offsets(raw, offsets, size, pdu_len_at):
+        """ Fill offsets with the start of each complete record header in raw, return the number of records. """
+        end = raw.shape[0]
+        off = 0
+        n = 0
+        while off + size <= end:
+            offsets[n] = off
+            n += 1
+            pdu_len = np.int64(raw[off + pdu_len_at]) | (np.int64(raw[off + pdu_len_at + 1]) << 8)
+            off += size + pdu_len
+
+        return n
+else:
+    _scan_offsets = None
+
+
+def record_offsets(buf) -> np.ndarray:
+    """ Return the start offset of every complete record header in buf, skipping over the pdu payloads. """
+    if _scan_offsets is not None:
+        raw = np.frombuffer(buf, dtype=np.uint8)
+        offsets = np.empty(len(raw) // _DTYPE.itemsize, dtype=np.intp)
+        n = _scan_offsets(raw, offsets, _DTYPE.itemsize, _PDU_LEN_AT)
+        return offsets[:n]
+
+    unpack_from = _PDU_LEN.unpack_from
+    size = _DTYPE.itemsize
+    end = len(buf)
+    off = 0
+
+    offsets = []
+    while off + size <= end:
+        offsets.append(off)
+        off += size + unpack_from(buf, off + _PDU_LEN_AT)[0]
+
+    return np.array(offsets, dtype=np.intp)
+
+
+def read_columns(buf) -> np.ndarray:
+    """ Return the headers of all records in buf (usually from map_file()) as a structured array.
+
+    Column access works by name, arr['time'], arr['action'] and so on. The pdu payloads are not part of the result.
+
+    If no record in buf carries a payload, the result is a read-only view of buf, not a copy: it cannot be written to,
+    and an mmap behind it cannot be closed while the array is alive. Use arr.copy() where that matters.
+    Traces with payloads always give a writable copy.
+    """
+    size = _DTYPE.itemsize
+    raw = np.frombuffer(buf, dtype=np.uint8)
+
+    # Fast path: no record carries a payload, so the file is a plain array of headers.
+    arr = None
+    if len(raw) % size == 0:
+        arr = raw.view(_DTYPE)
+        if arr['pdu_len'].any():
+            arr = None
+
+    # Otherwise find the headers first, then gather them in one go.
+    # The window view costs no memory, indexing it copies only the selected headers.
+    if arr is None:
+        offsets = record_offsets(buf)
+        if len(raw) < size:
+            return np.empty(0, dtype=_DTYPE)
+        windows = np.lib.stride_tricks.sliding_window_view(raw, size)
+        arr = windows[offsets].view(_DTYPE).ravel()
+
+    # One vectorized compare checks every record, _verify() only runs to explain the first mismatch.
+    bad = arr['magic'] != (_MAGIC | _VERSION)
+    if bad.any():
+        _verify(int(arr['magic'][bad.argmax()]))
+
+    return arr
+
+
+def classify_columns(arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ Vectorized classify(): return category, action/notify and cgroup bits of each record as int arrays. """
+    action = arr['action'].view('<u4')
+    return action & CATEGORY_MASK, action & ACTION_MASK, action & CGROUP_MASK
+
+
+def as_timepairs(arr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """ Vectorized BlkparseRecord.as_timepair(): return the record times as (seconds, nanoseconds) arrays. """
+    time = arr['time']
+    sec = time // 1_000_000_000
+    return sec, time - sec * 1_000_000_000
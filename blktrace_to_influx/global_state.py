@@ -1,8 +1,10 @@
+import sys
 from typing import Optional
 
 from blktrace_to_influx.blktrace_api import BlkparseRecord
 
 class GlobalState:
+    __slots__ = ('ppm', 'debug', 'start_timestamp', 'abs_timestamp')
 
     def __init__(self):
         self.ppm = dict()
@@ -15,14 +17,15 @@ class GlobalState:
 
     def add_program(self, r: BlkparseRecord):
         pid = r.pid
-        offset = r.pdu_data.find(b'\0')
-        if offset:
-            program = r.pdu_data[0:offset].decode('utf_8')
-        else:
-            program = r.pdu_data.decode('utf_8')
+        # The name is NUL padded, and may have no NUL at all if it fills the whole pdu.
+        # pdu_data is a view into the trace. bytes() copies the whole pdu (16 bytes for a PROCESS notify),
+        # which is cheaper than searching the view for the NUL from Python.
+        program = bytes(r.pdu_data).partition(b'\0')[0].decode('utf_8')
 
-        self.ppm[pid] = program
-        print(f"add_program({pid=}, {program=})")
+        # Many pids share few program names, keep one copy of each
+        self.ppm[pid] = sys.intern(program)
+        if self.debug:
+            print(f"add_program({pid=}, {program=})", file=sys.stderr)
 
     def ppm_by_pid(self, pid: int) -> Optional[str]:
         return self.ppm.get(pid, None)
@@ -0,0 +1,60 @@
+import shutil
+import struct
+from pathlib import Path
+
+from click.testing import CliRunner
+
+from blktrace_to_influx.blktrace_api import ACTION_MASK, NOTIFY_MASK, NOTIFY_TIMESTAMP, iter_records, map_file
+from blktrace_to_influx.cli import cli
+
+TESTDATA = Path(__file__).parent / "testdata"
+
+
+def wall_clock_offset() -> int:
+    """ Offset from kernel clock ns to wall clock ns, from the TIMESTAMP notify in keks.blktrace.6 """
+    with open(TESTDATA / "keks.blktrace.6", "rb") as f:
+        for r in iter_records(map_file(f)):
+            if r.action & NOTIFY_MASK and r.action & ACTION_MASK == NOTIFY_TIMESTAMP:
+                sec, nanosec = struct.unpack("<ii", r.pdu_data)
+                return sec * 1000000000 + nanosec - r.time
+
+    raise AssertionError("keks.blktrace.6 has no TIMESTAMP notify")
+
+
+def first_io_time(path: Path) -> int:
+    with open(path, "rb") as f:
+        return next(r.time for r in iter_records(map_file(f)) if not r.action & NOTIFY_MASK)
+
+
+def test_dumpfile_uses_timestamp_of_sibling_file():
+    result = CliRunner().invoke(cli, ["dumpfile", "-D", str(TESTDATA), "keks.blktrace.0"])
+    assert result.exit_code == 0, result.output
+
+    lines = result.stdout.splitlines()
+    assert lines
+    assert all(line.startswith("disk,major=8,minor=52,") for line in lines)
+
+    timestamp = int(lines[0].rsplit(" ", 1)[1])
+    assert timestamp == first_io_time(TESTDATA / "keks.blktrace.0") + wall_clock_offset()
+
+
+def test_dumpfile_skips_siblings_that_are_not_traces(tmp_path):
+    for name in ("keks.blktrace.0", "keks.blktrace.6"):
+        shutil.copy(TESTDATA / name, tmp_path)
+    (tmp_path / "keks.blktrace.1.gz").write_bytes(b"\x1f\x8b" + b"\0" * 100)
+    (tmp_path / "keks.blktrace.3").write_bytes(b"\xff" * 100)
+    (tmp_path / "keks.blktrace.2").mkdir()
+
+    result = CliRunner().invoke(cli, ["dumpfile", "-D", str(tmp_path), "keks.blktrace.0"])
+    assert result.exit_code == 0, result.output
+
+    timestamp = int(result.stdout.splitlines()[0].rsplit(" ", 1)[1])
+    assert timestamp == first_io_time(TESTDATA / "keks.blktrace.0") + wall_clock_offset()
+
+
+def test_dumpfile_without_timestamp_fails(tmp_path):
+    shutil.copy(TESTDATA / "keks.blktrace.0", tmp_path)
+
+    result = CliRunner().invoke(cli, ["dumpfile", "-D", str(tmp_path), "keks.blktrace.0"])
+    assert result.exit_code == 1
+    assert "No TIMESTAMP notify" in result.output
@@ -0,0 +1,63 @@
+from pathlib import Path
+
+import pytest
+
+from blktrace_to_influx.blktrace_api import _MAGIC, _RECORD, _VERSION, iter_records, map_file
+
+TESTDATA = Path(__file__).parent / "testdata"
+TRACES = sorted(TESTDATA.glob("keks.blktrace.*"))
+
+
+def read_trace(path: Path):
+    with open(path, "rb") as f:
+        return map_file(f)
+
+
+def make_record(sequence: int, action: int, pdu: bytes = b"", magic: int = _MAGIC | _VERSION) -> bytes:
+    return _RECORD.pack(magic, sequence, sequence, 0, 0, action, 1, 0, 0, 0, len(pdu)) + pdu
+
+
+def test_testdata_present():
+    assert len(TRACES) == 8
+
+
+@pytest.mark.parametrize("path", TRACES, ids=lambda p: p.name)
+def test_iter_records_consumes_whole_trace(path):
+    mm = read_trace(path)
+    size = sum(_RECORD.size + r.pdu_len for r in iter_records(mm))
+    assert size == len(mm)
+
+
+@pytest.mark.parametrize("path", TRACES, ids=lambda p: p.name)
+def test_read_columns_matches_iter_records(path):
+    columnar = pytest.importorskip("blktrace_to_influx.columnar")
+
+    mm = read_trace(path)
+    records = list(iter_records(mm))
+    arr = columnar.read_columns(mm)
+
+    assert len(arr) == len(records)
+    for name in columnar._DTYPE.names:
+        assert arr[name].tolist() == [getattr(r, name) for r in records], name
+
+
+def test_large_pdu_len_is_unsigned():
+    buf = make_record(0, 1 << 26, b"\0" * 0x9000) + make_record(1, 1)
+
+    records = list(iter_records(buf))
+    assert [r.pdu_len for r in records] == [0x9000, 0]
+    assert len(records[0].pdu_data) == 0x9000
+
+    columnar = pytest.importorskip("blktrace_to_influx.columnar")
+    assert columnar.read_columns(buf)['pdu_len'].tolist() == [0x9000, 0]
+
+
+def test_bad_version_raises():
+    buf = make_record(0, 1) + make_record(1, 1, magic=_MAGIC | 8)
+
+    with pytest.raises(ValueError, match="Version found 8, expected 7"):
+        list(iter_records(buf))
+
+    columnar = pytest.importorskip("blktrace_to_influx.columnar")
+    with pytest.raises(ValueError, match="Version found 8, expected 7"):
+        columnar.read_columns(buf)